@@ -4,14 +4,26 @@ import sys
 import os
 import re
 import time
+import itertools
+import concurrent.futures
+import threading
+import io
+import collections
+import random
 import logging
 from flask import Flask, request, jsonify
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
 from googleapiclient.errors import HttpError
+from googleapiclient.model import JsonModel
+import orjson
 import google.auth
+from google.auth.transport.requests import AuthorizedSession
+import requests
 from google.cloud import datastore
 from google.cloud import storage
+from google.api_core.exceptions import PreconditionFailed
 import google.cloud.logging
+import pybase64
 from google.oauth2 import service_account
 
 # Detect if running in Cloud Run
@@ -60,7 +72,20 @@ PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT")
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 BUCKET_NAME = os.getenv("GCS_BUCKET")
 KEY_FILE_PATH = "/etc/secrets/key.json" # Path where secret is mounted
+GMAIL_DISCOVERY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gmail_discovery.json") # Downloaded at image build time
 TOPIC_NAME = "gmail-watch"
+GMAIL_BATCH_SIZE = 100 # Maximum number of calls allowed in a single Gmail batch request
+GMAIL_NUM_RETRIES = 5 # Retries with exponential backoff on transient Gmail API errors
+GMAIL_RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+GMAIL_MAX_RETRY_DELAY = 32 # Seconds, longer Retry-After are left to Pub/Sub redelivery
+GMAIL_RETRYABLE_403_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded') # Per-user quota errors
+MESSAGE_FIELDS = "id,payload(parts(filename,mimeType,body(attachmentId,size)))" # Only what is needed to locate attachments
+MESSAGE_METADATA_FIELDS = "id,payload(mimeType)" # Only what is needed to tell whether a message may have attachments
+DECODE_CHUNK_SIZE = 1 << 16 # Base64 characters decoded at a time, must be a multiple of 4
+ATTACHMENT_BATCH_MAX_BYTES = 8 << 20 # Total attachment size fetched in a single batch, the whole batch response is held in memory
+ATTACHMENT_SINGLE_FETCH_SIZE = 4 << 20 # Attachments larger than this are fetched one at a time
+UPLOAD_MAX_WORKERS = 16 # Number of parallel uploads to GCS
+PROCESSED_PUBSUB_CACHE_SIZE = 1024 # Number of recently processed Pub/Sub message IDs remembered
 
 # --- Initialize Clients ---
 try:
@@ -70,11 +95,26 @@ except Exception as e:
     datastore_client = None
 
 try:
-    storage_client = storage.Client(project=PROJECT_ID)
+    # Shared HTTP session with a connection pool sized for parallel uploads, so TLS connections get reused
+    storage_credentials, _ = google.auth.default(scopes=['https://www.googleapis.com/auth/cloud-platform'])
+    storage_session = AuthorizedSession(storage_credentials)
+    storage_session.mount('https://', requests.adapters.HTTPAdapter(
+        pool_connections=32, pool_maxsize=64, max_retries=3))
+    storage_client = storage.Client(project=PROJECT_ID, _http=storage_session)
 except Exception as e:
     logger.error(f"Error initializing Storage Client: {e}")
     storage_client = None
 
+try:
+    with open(GMAIL_DISCOVERY_PATH) as f:
+        gmail_discovery_document = f.read()
+except Exception as e:
+    logger.info(f"Discovery document not available at {GMAIL_DISCOVERY_PATH}, using the one bundled with the client library: {e}")
+    gmail_discovery_document = None
+
+# Thread pool used to upload attachments to GCS in parallel
+upload_executor = concurrent.futures.ThreadPoolExecutor(max_workers=UPLOAD_MAX_WORKERS)
+
 # --- Datastore Key ---
 DATASTORE_KIND = "GmailSyncStateRun"
 DATASTORE_KEY = f"last_history_id_{TARGET_USER_EMAIL}"
@@ -82,88 +122,318 @@ DATASTORE_KEY = f"last_history_id_{TARGET_USER_EMAIL}"
 app = Flask(__name__)
 
 # --- Gmail Helper Functions ---
-def get_gmail_service(user_email):
-    """Creates and returns a Gmail API service object with delegation."""
-    try:
-        if not os.path.exists(KEY_FILE_PATH):
+class OrjsonModel(JsonModel):
+    """JSON model for the Gmail API client parsing responses with orjson."""
+
+    def deserialize(self, content):
+        # Same as JsonModel.deserialize: bodies that are not JSON are returned as is
+        try:
+            content = content.decode('utf-8')
+        except AttributeError:
+            pass
+        try:
+            body = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            body = content
+        else:
+            if self._data_wrapper and 'data' in body:
+                body = body['data']
+        return body
+
+# Delegated credentials, loaded on first use and reloaded when the mounted key file changes
+_gmail_credentials = None
+_gmail_credentials_mtime = None
+_gmail_credentials_lock = threading.Lock()
+
+def get_gmail_credentials():
+    """Returns the delegated Gmail credentials, loading them from the key file if not loaded yet or if it changed.
+    Token refresh is handled lazily by the credentials."""
+    global _gmail_credentials, _gmail_credentials_mtime
+    mtime = os.path.getmtime(KEY_FILE_PATH) if os.path.exists(KEY_FILE_PATH) else None
+    with _gmail_credentials_lock:
+        if _gmail_credentials and (mtime is None or mtime == _gmail_credentials_mtime):
+            return _gmail_credentials
+        if mtime is None:
             raise FileNotFoundError(f"Secret file not found at {KEY_FILE_PATH}")
-
-        credentials = service_account.Credentials.from_service_account_file(
+        _gmail_credentials = service_account.Credentials.from_service_account_file(
             KEY_FILE_PATH, scopes=SCOPES
-        )
-        delegated_credentials = credentials.with_subject(user_email)
-        service = build('gmail', 'v1', credentials=delegated_credentials)
-        return service
-    except Exception as e:
-        logger.error(f"Error creating Gmail service for {user_email}: {e}")
-        return None
+        ).with_subject(TARGET_USER_EMAIL)
+        _gmail_credentials_mtime = mtime
+        return _gmail_credentials
 
-def get_message(service, user_id, msg_id):
-    """Gets a specific message."""
-    try:
-        message = service.users().messages().get(userId=user_id, id=msg_id, format='full').execute()
-        return message
-    except HttpError as error:
-        logger.error(f"An error occurred while getting message {msg_id}: {error}")
-        return None
+# Service objects are not thread-safe (they share an httplib2 connection), keep one per thread
+_gmail_services = threading.local()
 
-def get_attachment(service, user_id, msg_id, attachment_id):
-    """Gets and decodes a specific attachment."""
+def get_cached_gmail_service():
+    """Returns the Gmail API service object with delegation for the current thread,
+    building it on first use or when the credentials were reloaded."""
     try:
-        attachment = service.users().messages().attachments().get(
-            userId=user_id, messageId=msg_id, id=attachment_id).execute()
-        data = attachment.get('data')
-        if data:
-            return base64.urlsafe_b64decode(data.encode('UTF-8'))
-        return None
-    except HttpError as error:
-        logger.error(f"An error occurred while getting attachment {attachment_id}: {error}")
+        gmail_credentials = get_gmail_credentials()
+    except Exception as e:
+        logger.error(f"Error loading Gmail credentials for {TARGET_USER_EMAIL}: {e}")
         return None
+    service = getattr(_gmail_services, 'service', None)
+    if service and _gmail_services.credentials is gmail_credentials:
+        return service
+    service = None
+    try:
+        if gmail_discovery_document:
+            service = build_from_document(gmail_discovery_document, credentials=gmail_credentials,
+                                          model=OrjsonModel())
+        else:
+            service = build('gmail', 'v1', credentials=gmail_credentials,
+                            cache_discovery=False, static_discovery=True, model=OrjsonModel())
+        _gmail_services.service = service
+        _gmail_services.credentials = gmail_credentials
+    except Exception as e:
+        logger.error(f"Error creating Gmail service for {TARGET_USER_EMAIL}: {e}")
+    return service
+
+def is_retryable_error(error):
+    """Tells whether a Gmail API error is transient and the request should be retried."""
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status in GMAIL_RETRYABLE_STATUSES:
+        return True
+    if error.resp.status == 403 and isinstance(error.error_details, list):
+        return any(isinstance(detail, dict) and detail.get('reason') in GMAIL_RETRYABLE_403_REASONS
+                   for detail in error.error_details)
+    return False
+
+def get_retry_delay(errors, attempt):
+    """Returns the time to wait before a retry: exponential backoff, or longer if a Retry-After header asks for it.
+    Raises the error if its Retry-After exceeds GMAIL_MAX_RETRY_DELAY, to not hold the request thread."""
+    delay = 2 ** attempt + random.random()
+    for error in errors:
+        retry_after = error.resp.get('retry-after')
+        if retry_after and retry_after.isdigit():
+            if int(retry_after) > GMAIL_MAX_RETRY_DELAY:
+                logger.error(f"Gmail API asked to retry after {retry_after}s, giving up: {error}")
+                raise error
+            delay = max(delay, int(retry_after))
+    return min(delay, GMAIL_MAX_RETRY_DELAY)
+
+def execute_batch(service, request_ids, build_request, callback):
+    """Executes requests using batch requests of at most GMAIL_BATCH_SIZE calls.
+    `build_request` returns the request for a request ID, `callback` is called with each response.
+    Requests failing with a transient error are retried with exponential backoff.
+    Raises HttpError if a whole batch request fails with a non transient error, or after the last retry."""
+    pending = list(request_ids)
+    for attempt in range(GMAIL_NUM_RETRIES + 1):
+        retry = []
+        retry_errors = []
+
+        def on_response(request_id, response, exception):
+            if is_retryable_error(exception) and attempt < GMAIL_NUM_RETRIES:
+                retry.append(request_id)
+                retry_errors.append(exception)
+                return
+            callback(request_id, response, exception)
+
+        request_ids = iter(pending)
+        while True:
+            chunk = list(itertools.islice(request_ids, GMAIL_BATCH_SIZE))
+            if not chunk:
+                break
+            batch = service.new_batch_http_request(callback=on_response)
+            for request_id in chunk:
+                batch.add(build_request(request_id), request_id=request_id)
+            try:
+                batch.execute()
+            except HttpError as error:
+                if not is_retryable_error(error) or attempt == GMAIL_NUM_RETRIES:
+                    logger.error(f"An error occurred while executing batch request: {error}")
+                    raise
+                # No callback was called, retry the whole batch
+                retry.extend(chunk)
+                retry_errors.append(error)
+
+        if not retry:
+            break
+        logger.info(f"Retrying {len(retry)} request(s) after transient errors")
+        time.sleep(get_retry_delay(retry_errors, attempt))
+        pending = retry
+
+def get_messages(service, user_id, msg_ids, format='full', fields=MESSAGE_FIELDS):
+    """Gets several messages using batch requests.
+    Returns a list of (msg_id, message) tuples for the messages successfully fetched."""
+    messages = []
+
+    def on_message(request_id, response, exception):
+        if exception is not None:
+            logger.error(f"An error occurred while getting message {request_id}: {exception}")
+            return
+        messages.append((request_id, response))
+
+    execute_batch(service, msg_ids, lambda msg_id: service.users().messages().get(
+        userId=user_id, id=msg_id, format=format, fields=fields), on_message)
+    return messages
+
+def may_have_attachments(message):
+    """Tells from the MIME type of a message payload whether it may have attachments.
+    Single part messages and multipart/alternative ones have no top-level part with a filename."""
+    mime_type = message.get('payload', {}).get('mimeType', '')
+    return mime_type.startswith('multipart/') and mime_type != 'multipart/alternative'
+
+def list_history(service, user_id, start_history_id):
+    """Yields all the pages of the INBOX messageAdded history starting at start_history_id."""
+    page_token = None
+    while True:
+        history = service.users().history().list(
+            userId=user_id,
+            startHistoryId=start_history_id,
+            historyTypes=['messageAdded'],
+            labelId='INBOX',
+            pageToken=page_token
+        ).execute(num_retries=GMAIL_NUM_RETRIES)
+        yield history
+        page_token = history.get('nextPageToken')
+        if not page_token:
+            break
+
+def decode_attachment(attachment):
+    """Decodes the data of an attachment resource chunk by chunk into an in-memory file.
+    Returns the file, positioned at its start, and its size, or (None, 0) if the attachment has no data."""
+    data = attachment.get('data')
+    if not data:
+        return None, 0
+    # Gmail may omit the trailing padding
+    data += '=' * (-len(data) % 4)
+    attachment_file = io.BytesIO()
+    for start in range(0, len(data), DECODE_CHUNK_SIZE):
+        attachment_file.write(pybase64.urlsafe_b64decode(data[start:start + DECODE_CHUNK_SIZE]))
+    size = attachment_file.tell()
+    attachment_file.seek(0)
+    return attachment_file, size
+
+def chunk_attachments(attachments):
+    """Splits attachments into groups whose total size fits in ATTACHMENT_BATCH_MAX_BYTES.
+    Attachments larger than ATTACHMENT_SINGLE_FETCH_SIZE, or of unknown size, get a group of their own."""
+    chunk, chunk_size = [], 0
+    for attachment in attachments:
+        size = attachment[5]
+        if size is None or size > ATTACHMENT_SINGLE_FETCH_SIZE:
+            yield [attachment]
+            continue
+        if chunk and (len(chunk) == GMAIL_BATCH_SIZE or chunk_size + size > ATTACHMENT_BATCH_MAX_BYTES):
+            yield chunk
+            chunk, chunk_size = [], 0
+        chunk.append(attachment)
+        chunk_size += size
+    if chunk:
+        yield chunk
+
+def upload_attachments(service, user_id, attachments):
+    """Gets attachments using size-bounded batch requests and uploads them to GCS in parallel.
+    `attachments` is a list of (msg_id, attachment_id, filename, index, content_type, size) tuples.
+    Each batch is uploaded before the next one is fetched, to bound memory usage."""
+    attachments_by_request_id = {f"{a[0]}:{a[1]}": a for a in attachments}
+    futures = []
+
+    def on_attachment(request_id, response, exception):
+        msg_id, attachment_id, filename, i, content_type, _ = attachments_by_request_id[request_id]
+        if exception is not None:
+            logger.error(f"An error occurred while getting attachment {attachment_id}: {exception}")
+            return
+        try:
+            attachment_file, size = decode_attachment(response)
+            if attachment_file:
+                sane_filename = sanitize_filename(filename)
+                destination_blob_name = f"{msg_id}/{i}_{sane_filename}"
+                future = upload_executor.submit(
+                    upload_to_gcs, BUCKET_NAME, destination_blob_name, attachment_file, content_type, size)
+                future.add_done_callback(lambda _, f=attachment_file: f.close())
+                futures.append(future)
+        except Exception as e:
+            logger.error(f"Error fetching/uploading attachment {filename}: {e}")
+
+    def build_request(request_id):
+        msg_id, attachment_id = attachments_by_request_id[request_id][:2]
+        return service.users().messages().attachments().get(
+            userId=user_id, messageId=msg_id, id=attachment_id)
+
+    for chunk in chunk_attachments(attachments):
+        execute_batch(service, [f"{a[0]}:{a[1]}" for a in chunk], build_request, on_attachment)
+        concurrent.futures.wait(futures)
+        futures.clear()
 
 # --- GCS Helper Functions ---
+# Runs of unsafe characters and underscores, each collapsed into a single underscore
+_SANITIZE_RE = re.compile(r'[^a-zA-Z0-9.-]+')
+
 def sanitize_filename(filename):
     """Removes or replaces characters that are not safe for GCS object names."""
     if not filename:
         return "unnamed_attachment"
-    sani = re.sub(r'[^a-zA-Z0-9_.-]', '_', filename)
-    sani = re.sub(r'_+', '_', sani)
-    sani = sani.strip('_.-')
-    return sani if sani else "attachment"
+    return _SANITIZE_RE.sub('_', filename).strip('_.-') or "attachment"
 
-def upload_to_gcs(bucket_name, destination_blob_name, data, content_type=None):
-    """Uploads data to a GCS bucket."""
+def upload_to_gcs(bucket_name, destination_blob_name, file_obj, content_type=None, size=None):
+    """Uploads the content of a file object to a GCS bucket.
+    Passing the size lets small files be sent in a single multipart request instead of a resumable upload."""
     if not storage_client:
         logger.error("Error: Storage client not initialized.")
         return False
     try:
         bucket = storage_client.bucket(bucket_name)
         blob = bucket.blob(destination_blob_name)
-        blob.upload_from_string(data, content_type=content_type)
+        # Only create the blob if it does not exist yet, e.g. from a previous delivery of the same notification
+        blob.upload_from_file(file_obj, rewind=True, size=size, content_type=content_type, if_generation_match=0)
         logger.info(f"Successfully uploaded to gs://{bucket_name}/{destination_blob_name}")
         return True
+    except PreconditionFailed:
+        logger.info(f"gs://{bucket_name}/{destination_blob_name} already exists, skipping upload")
+        return True
     except Exception as e:
         logger.error(f"Error uploading to GCS gs://{bucket_name}/{destination_blob_name}: {e}")
         return False
 
 # --- Datastore Helper Functions ---
+# In-process cache of the last saved historyId, populated on first read and kept up to date on write
+_last_history_id = None
+_last_history_id_lock = threading.Lock()
+
 def get_last_history_id():
-    """Retrieves the last saved historyId from Datastore."""
+    """Retrieves the last saved historyId, from the in-process cache or from Datastore."""
+    global _last_history_id
     if not datastore_client: return None
-    key = datastore_client.key(DATASTORE_KIND, DATASTORE_KEY)
-    entity = datastore_client.get(key)
-    return entity['historyId'] if entity else None
+    with _last_history_id_lock:
+        if _last_history_id is None:
+            key = datastore_client.key(DATASTORE_KIND, DATASTORE_KEY)
+            entity = datastore_client.get(key)
+            _last_history_id = entity['historyId'] if entity else None
+        return _last_history_id
 
 def save_last_history_id(history_id):
-    """Saves the latest historyId to Datastore."""
+    """Saves the latest historyId to Datastore and to the in-process cache.
+    The historyId only moves forward: concurrent handlers may finish out of order."""
+    global _last_history_id
     if not datastore_client: return
     key = datastore_client.key(DATASTORE_KIND, DATASTORE_KEY)
     entity = datastore.Entity(key=key)
     entity.update({'historyId': int(history_id)})
-    datastore_client.put(entity)
+    with _last_history_id_lock:
+        if _last_history_id is not None and int(history_id) <= _last_history_id:
+            logger.info(f"Not saving historyId {history_id}, already at {_last_history_id}")
+            return
+        try:
+            datastore_client.put(entity)
+        except Exception:
+            # The stored value is unknown, read it again from Datastore next time
+            _last_history_id = None
+            raise
+        _last_history_id = int(history_id)
     logger.info(f"Saved last historyId to Datastore: {history_id}")
 
 # --- Main Processing Function ---
+# Concurrent pushes in a burst all start from the same historyId, process them one at a time
+# so that queued pushes see the updated historyId and skip instead of repeating the same work
+_process_new_mail_lock = threading.Lock()
+
 def process_new_mail(service, current_history_id_from_pubsub):
+    with _process_new_mail_lock:
+        _process_new_mail(service, current_history_id_from_pubsub)
+
+def _process_new_mail(service, current_history_id_from_pubsub):
     if not datastore_client:
         raise RuntimeError("Datastore client not initialized.")
 
@@ -184,38 +454,44 @@ def process_new_mail(service, current_history_id_from_pubsub):
 
     logger.info(f"Processing history from {start_history_id} to {current_history_id}")
 
+    new_history_id = start_history_id
+    changes = []
     try:
-        history = service.users().history().list(
-            userId=TARGET_USER_EMAIL,
-            startHistoryId=start_history_id
-        ).execute()
+        for history in list_history(service, TARGET_USER_EMAIL, start_history_id):
+            new_history_id = history.get('historyId', new_history_id)
+            changes.extend(history.get('history', []))
     except HttpError as error:
         logger.error(f"Error fetching history: {error}")
         raise error
 
-    new_history_id = history.get('historyId', start_history_id)
-    changes = history.get('history', [])
-
     if not changes:
         logger.info(f"No new changes in history range.")
         if int(new_history_id) > start_history_id:
              save_last_history_id(new_history_id)
         return
 
-    message_ids = set()
+    message_ids = {} # Insertion-ordered set, keeps Gmail's history order across runs
     for change in changes:
         messages_added = change.get('messagesAdded', [])
         for msg_added in messages_added:
             msg = msg_added.get('message', {})
-            if msg and 'id' in msg and 'INBOX' in msg.get('labelIds', []):
-                message_ids.add(msg['id'])
+            # Only INBOX messages are returned by list_history, no need to check the labels again
+            if msg and 'id' in msg:
+                message_ids[msg['id']] = None
 
     if not message_ids:
         logger.info(f"No new INBOX messages in history changes.")
     else:
-        logger.info(f"New message IDs to process: {message_ids}")
-        for msg_id in message_ids:
-            message = get_message(service, TARGET_USER_EMAIL, msg_id)
+        logger.info(f"New message IDs to process: {list(message_ids)}")
+        attachments = []
+        fetched_messages = []
+        # Fetch the small metadata payload first, and the parts only for messages that may have attachments
+        multipart_ids = [msg_id for msg_id, metadata in get_messages(
+            service, TARGET_USER_EMAIL, message_ids, format='metadata', fields=MESSAGE_METADATA_FIELDS)
+            if may_have_attachments(metadata)]
+        if multipart_ids:
+            fetched_messages = get_messages(service, TARGET_USER_EMAIL, multipart_ids)
+        for msg_id, message in fetched_messages:
             if message:
                 payload = message.get('payload', {})
                 logger.info(f"  Processing Message ID: {msg_id}")
@@ -229,18 +505,35 @@ def process_new_mail(service, current_history_id_from_pubsub):
                             body = part.get('body', {})
                             attachment_id = body.get('attachmentId')
                             if attachment_id:
-                                try:
-                                    attachment_data = get_attachment(service, TARGET_USER_EMAIL, msg_id, attachment_id)
-                                    if attachment_data:
-                                        sane_filename = sanitize_filename(filename)
-                                        destination_blob_name = f"{msg_id}/{i}_{sane_filename}"
-                                        upload_to_gcs(BUCKET_NAME, destination_blob_name, attachment_data, content_type)
-                                except Exception as e:
-                                    logger.info(f"Error fetching/uploading attachment {filename}: {e}")
+                                attachments.append((msg_id, attachment_id, filename, i, content_type, body.get('size')))
+
+        if attachments:
+            upload_attachments(service, TARGET_USER_EMAIL, attachments)
 
     save_last_history_id(new_history_id)
     logger.info(f"Finished processing. Updated history to {new_history_id}")
 
+# --- Pub/Sub Deduplication ---
+# Recently processed Pub/Sub message IDs, used to acknowledge redeliveries without processing them again
+_processed_pubsub_ids = collections.OrderedDict()
+_processed_pubsub_ids_lock = threading.Lock()
+
+def is_pubsub_message_processed(message_id):
+    """Returns whether the Pub/Sub message was recently processed successfully."""
+    with _processed_pubsub_ids_lock:
+        if message_id in _processed_pubsub_ids:
+            _processed_pubsub_ids.move_to_end(message_id)
+            return True
+        return False
+
+def mark_pubsub_message_processed(message_id):
+    """Remembers a successfully processed Pub/Sub message, evicting the oldest ones."""
+    with _processed_pubsub_ids_lock:
+        _processed_pubsub_ids[message_id] = None
+        _processed_pubsub_ids.move_to_end(message_id)
+        while len(_processed_pubsub_ids) > PROCESSED_PUBSUB_CACHE_SIZE:
+            _processed_pubsub_ids.popitem(last=False)
+
 # --- Pub/Sub Push Endpoint ---
 @app.route('/', methods=['POST'])
 def process_pubsub_push():
@@ -259,13 +552,17 @@ def process_pubsub_push():
         logger.error("Bad Request: invalid Pub/Sub message format")
         return "", 400
 
-    logger.info(f"Received Pub/Sub message: {pubsub_message.get('messageId')}")
+    pubsub_message_id = pubsub_message.get('messageId')
+    logger.info(f"Received Pub/Sub message: {pubsub_message_id}")
+
+    if pubsub_message_id and is_pubsub_message_processed(pubsub_message_id):
+        logger.info(f"Pub/Sub message {pubsub_message_id} already processed, ignoring.")
+        return "", 204
 
     try:
         if 'data' in pubsub_message:
             data_b64 = pubsub_message['data']
-            data_str = base64.b64decode(data_b64).decode('utf-8')
-            notification = json.loads(data_str)
+            notification = orjson.loads(base64.b64decode(data_b64))
 
             email_address = notification.get('emailAddress')
             history_id = notification.get('historyId')
@@ -276,17 +573,19 @@ def process_pubsub_push():
 
             logger.info(f"Received notification for {email_address}, Triggering History ID: {history_id}")
 
-            service = get_gmail_service(TARGET_USER_EMAIL)
+            service = get_cached_gmail_service()
             if not service:
                 return jsonify({"error": "Failed to get Gmail service"}), 500
 
             process_new_mail(service, history_id)
+            if pubsub_message_id:
+                mark_pubsub_message_processed(pubsub_message_id)
             return "", 204 # ACK success
         else:
             logger.error("Bad Request: no data in Pub/Sub message")
             return "", 400
 
-    except json.JSONDecodeError:
+    except json.JSONDecodeError: # Also raised by orjson
         logger.error("Bad Request: could not decode JSON data")
         return "", 400
     except Exception as e:
@@ -298,7 +597,7 @@ def process_pubsub_push():
 def renew_gmail_push_permissions():
     logger.info("Activating Gmail push notification permissions...")
     try:
-        service = get_gmail_service(TARGET_USER_EMAIL)
+        service = get_cached_gmail_service()
         if not service:
             return jsonify({"error": "Failed to get Gmail service"}), 500
 
@@ -308,7 +607,7 @@ def renew_gmail_push_permissions():
             'labelFilterBehavior': 'INCLUDE'
         }
 
-        service.users().watch(userId=TARGET_USER_EMAIL, body=request).execute()
+        service.users().watch(userId=TARGET_USER_EMAIL, body=request).execute(num_retries=GMAIL_NUM_RETRIES)
         logger.info("Successfully renewed Gmail push notification permissions")
         return f"Gmail push notification permissions renewed for topic {TOPIC_NAME} for the next 7 days", 200
 
@@ -321,11 +620,11 @@ def renew_gmail_push_permissions():
 def revoke_gmail_push_permissions():
     logger.info("Revoking Gmail push notification permissions")
     try:
-        service = get_gmail_service(TARGET_USER_EMAIL)
+        service = get_cached_gmail_service()
         if not service:
             return jsonify({"error": "Failed to get Gmail service"}), 500
 
-        service.users().stop(userId=TARGET_USER_EMAIL).execute()
+        service.users().stop(userId=TARGET_USER_EMAIL).execute(num_retries=GMAIL_NUM_RETRIES)
         logger.info("Successfully revoked Gmail push notification permissions")
         return f"Gmail push notification permissions revoked", 200
 
@@ -333,9 +632,10 @@ def revoke_gmail_push_permissions():
         logger.error(f"Error processing message: {e}")
         return "", 500
 
-logger.info(f"Initial activation of push Notifications from Gmail to Pub/Sub topic {TOPIC_NAME}. It should be re-activated every week at most")
-renew_gmail_push_permissions()
-
 if __name__ == '__main__':
+    if not IN_CLOUD_RUN:
+        # In Cloud Run, push notifications are activated and renewed by the weekly Cloud Scheduler job
+        logger.info(f"Activation of push Notifications from Gmail to Pub/Sub topic {TOPIC_NAME}. It should be re-activated every week at most")
+        renew_gmail_push_permissions()
     port = int(os.environ.get('PORT', 8080))
     app.run(debug=True, host='0.0.0.0', port=port)
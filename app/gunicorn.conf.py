@@ -0,0 +1,15 @@
+import os
+
+# Gunicorn configuration, see https://docs.gunicorn.org/en/stable/settings.html
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+
+# A single worker process keeps the in-process caches (Gmail service, historyId,
+# processed Pub/Sub messages) shared by all requests; threads handle concurrent pushes
+workers = 1
+worker_class = 'gthread'
+threads = 8
+
+# Let Cloud Run enforce the request timeout instead of killing busy workers
+timeout = 0
+# Keep connections from the Cloud Run front end open longer than its idle timeout
+keepalive = 75
@@ -254,4 +254,8 @@ terraform apply -auto-approve
 
 echo "***** Cloud RUN URL *****"
 APP_URL=$(gcloud run services describe $SERVICE_NAME --region="$REGION" --format="value(status.url)")
-echo $APP_URL
\ No newline at end of file
+echo $APP_URL
+
+echo "***** Activating Gmail push notifications *****"
+# The weekly Cloud Scheduler job renews the Gmail watch, run it once now for the initial activation
+gcloud scheduler jobs run renew-gmail-push-permissions --location="$REGION" --project="$PROJECT_ID"
@@ -160,7 +160,9 @@ resource "google_cloud_run_v2_service" "email_automation" {
     service_account = data.google_service_account.cloud_run_sa.email
 
     # Set scaling configuration
-    max_instance_request_concurrency = 1
+    # Matches the number of gunicorn threads (app/gunicorn.conf.py), mail
+    # processing itself is serialized by the application
+    max_instance_request_concurrency = 8
     scaling {
       max_instance_count = 1
     }
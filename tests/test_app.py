@@ -0,0 +1,51 @@
+import base64
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+app = pytest.importorskip('app')
+
+
+@pytest.mark.parametrize('size', [0, 1, 2, 3, 4, 1000, app.DECODE_CHUNK_SIZE, 3 * app.DECODE_CHUNK_SIZE + 1])
+@pytest.mark.parametrize('padded', [True, False])
+def test_decode_attachment_matches_stdlib(size, padded):
+    raw = os.urandom(size)
+    data = base64.urlsafe_b64encode(raw).decode()
+    if not padded:
+        data = data.rstrip('=')
+    attachment_file, decoded_size = app.decode_attachment({'data': data})
+    if not data:
+        assert attachment_file is None
+        return
+    decoded = attachment_file.read()
+    assert decoded == base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+    assert decoded == raw
+    assert decoded_size == size
+
+
+def make_http_error(status, headers=None):
+    httplib2 = pytest.importorskip('httplib2')
+    resp = httplib2.Response(dict(headers or {}, status=status))
+    return app.HttpError(resp, b'')
+
+
+def test_get_retry_delay_honors_retry_after():
+    assert app.get_retry_delay([make_http_error(503, {'retry-after': '20'})], 0) == 20
+
+
+def test_get_retry_delay_is_capped():
+    assert app.get_retry_delay([make_http_error(503)], 10) == app.GMAIL_MAX_RETRY_DELAY
+
+
+def test_get_retry_delay_raises_on_long_retry_after():
+    error = make_http_error(503, {'retry-after': '120'})
+    with pytest.raises(app.HttpError):
+        app.get_retry_delay([error], 0)
+
+
+@pytest.mark.parametrize('content', [b'{"id": "1"}', '{"id": "1"}', b'not json', ''])
+def test_orjson_model_deserializes_like_json_model(content):
+    model = pytest.importorskip('googleapiclient.model')
+    assert app.OrjsonModel().deserialize(content) == model.JsonModel().deserialize(content)